@@ -1,17 +1,28 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request
 from flask_cors import CORS
-from PIL import Image
+from PIL import ExifTags, Image
 import google.generativeai as genai
-import tempfile
+import simplejpeg
+import functools
+import hashlib
+import io
 import os
-import json
-import pandas as pd
+import threading
+import re
+import orjson
 import joblib
+import numpy as np
+import redis
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
+from concurrent.futures import Future, ThreadPoolExecutor
 from pyNutriScore import NutriScore
 
 # Configure Gemini
 genai.configure(api_key=os.environ["GENAI_API_KEY"])
+GEMINI_MODEL = genai.GenerativeModel("models/gemini-1.5-flash")
 
 # Load model pipeline
 model_path = "food_consumption_model_xgb.pkl"
@@ -33,21 +44,380 @@ Return the result in JSON format like this:
 }
 """
 
+# Gemini downsamples vision input anyway; never decode or upload more than this.
+GEMINI_IMAGE_SIZE = (1024, 1024)
+JPEG_MAGIC = b"\xff\xd8\xff"
+# Formats Gemini accepts as-is, by Pillow format name.
+GEMINI_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+GEMINI_JPEG_QUALITY = 85
+# EXIF orientation -> transpose that puts the pixels upright.
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+NUTRITION_FACT_KEYS = (
+    "Calories", "Total Fat", "Saturated Fat", "Trans Fat", "Cholesterol", "Sodium",
+    "Total Carbohydrate", "Dietary Fiber", "Sugar", "Protein",
+)
+
+# Schema-constrained JSON mode: Gemini always returns a parseable object and
+# stops generating at its closing brace.
+GEMINI_JSON_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "OBJECT",
+        "properties": {
+            "ingredients": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "nutrition_facts": {
+                "type": "OBJECT",
+                "properties": {key: {"type": "STRING"} for key in NUTRITION_FACT_KEYS},
+            },
+        },
+        "required": ["ingredients", "nutrition_facts"],
+    },
+}
+
+NON_VEGAN_KEYWORDS = ("milk", "egg", "honey", "gelatin", "meat", "fish")
+NON_VEGAN_RE = re.compile("|".join(NON_VEGAN_KEYWORDS))
+ALLERGEN_TAG_TABLE = str.maketrans("_", " ")
+
+# Memoised helpers below are keyed on client-supplied strings; only cache
+# inputs up to this many characters so a worker can't be made to hold
+# arbitrarily large keys.
+MAX_CACHE_KEY_CHARS = 4096
+
+NUTRISCORE = NutriScore()
+
+# (response key, OpenFoodFacts nutriment key)
+OFF_NUTRIENT_MAP = (
+    ("Calories", "energy-kcal_100g"),
+    ("Total Fat", "fat_100g"),
+    ("Saturated Fat", "saturated-fat_100g"),
+    ("Sodium", "sodium_100g"),
+    ("Total Carbohydrate", "carbohydrates_100g"),
+    ("Sugar", "sugars_100g"),
+    ("Protein", "proteins_100g"),
+)
+
+# (pyNutriScore input key, OpenFoodFacts nutriment key)
+NUTRISCORE_INPUT_MAP = (
+    ('energy', "energy-kcal_100g"),
+    ('fibers', "fiber_100g"),
+    ('fruit_percentage', "fruits-vegetables-nuts_100g"),
+    ('proteins', "proteins_100g"),
+    ('saturated_fats', "saturated-fat_100g"),
+    ('sodium', "sodium_100g"),
+    ('sugar', "sugars_100g"),
+)
+
+# Bounds in-flight Gemini calls per process, whether they run on the request
+# thread or speculatively on the executor. Speculative calls never wait for a
+# slot: they only start when one is free, so they can't queue ahead of
+# requests that actually need Gemini.
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 8))
+gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY)
+
+# Parsed Gemini extractions keyed by a digest of the uploaded bytes, so
+# retries and repeat photos of the same package skip the model call.
+gemini_cache = TTLCache(maxsize=2000, ttl=24 * 3600)
+# Part of every extraction cache key, locally and in Redis. It changes with the
+# model, prompt or response schema, so entries of an old shape are never served.
+GEMINI_CACHE_VERSION = hashlib.blake2b(
+    orjson.dumps([GEMINI_MODEL.model_name, PROMPT, GEMINI_JSON_CONFIG]),
+    digest_size=4,
+).hexdigest()
+# Extractions currently running, keyed the same way; concurrent uploads of the
+# same image wait on the first call instead of issuing their own.
+gemini_inflight = {}
+gemini_cache_lock = threading.Lock()
+
+# One pooled keep-alive session for OpenFoodFacts so repeat lookups skip the
+# TCP and TLS handshakes.
+OFF_TIMEOUT = (0.5, 2.0)
+off_session = requests.Session()
+off_session.headers.update({"Accept-Encoding": "gzip"})
+off_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+))
+
+# Popular products get scanned over and over; keep found products for an hour.
+off_cache = TTLCache(maxsize=10000, ttl=3600)
+off_cache_lock = threading.Lock()
+OFF_FIELDS = "ingredients_text,allergens_tags,nutriments,nutriscore_grade,nutriscore_score"
+
+# Optional cache shared by all workers and instances; set REDIS_URL to enable.
+REDIS_URL = os.environ.get("REDIS_URL")
+OFF_REDIS_TTL = 24 * 3600
+GEMINI_REDIS_TTL = 7 * 24 * 3600
+redis_client = redis.Redis.from_url(
+    REDIS_URL,
+    socket_timeout=0.2,
+    socket_connect_timeout=0.2,
+) if REDIS_URL else None
+
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins="*")
 
 
+def json_response(payload):
+    return app.response_class(orjson.dumps(payload), mimetype="application/json")
+
+
 def flatten(value):
     if isinstance(value, list):
         return ', '.join(str(v).strip() for v in value)
     return str(value).strip()
 
 
-def query_openfoodfacts(barcode):
+def downscale_to_jpeg(buf, transpose=None):
+    # Decode at most GEMINI_IMAGE_SIZE worth of pixels and re-encode them as a
+    # lossy JPEG; simplejpeg handles both ends in a few milliseconds.
+    image = None
+    if buf.startswith(JPEG_MAGIC):
+        try:
+            image = Image.fromarray(simplejpeg.decode_jpeg(
+                buf,
+                colorspace="RGB",
+                min_width=GEMINI_IMAGE_SIZE[0],
+                min_height=GEMINI_IMAGE_SIZE[1],
+            ))
+        except ValueError:
+            # CMYK or otherwise unusual JPEGs: let Pillow handle them below
+            image = None
+    if image is None:
+        image = Image.open(io.BytesIO(buf))
+        image.draft("RGB", GEMINI_IMAGE_SIZE)
+    # Gemini re-samples the image itself; bilinear is plenty and much cheaper
+    # than thumbnail()'s bicubic default.
+    image.thumbnail(GEMINI_IMAGE_SIZE, Image.Resampling.BILINEAR)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if transpose is not None:
+        image = image.transpose(transpose)
+    return simplejpeg.encode_jpeg(
+        np.asarray(image), quality=GEMINI_JPEG_QUALITY, colorspace="RGB"
+    )
+
+
+def gemini_image_part(buf):
+    # Inline blob for generate_content. Never hand the SDK a PIL image built
+    # from memory: it re-encodes those as lossless WebP, which is slow and
+    # usually larger than the upload itself.
+    # Uploads that are already small enough go through untouched; anything
+    # larger is downscaled and re-encoded as a lossy JPEG, which bounds the
+    # payload at a few hundred KB.
+    header = Image.open(io.BytesIO(buf))
+    mime_type = GEMINI_MIME_TYPES.get(header.format)
+    if (mime_type is not None and header.width <= GEMINI_IMAGE_SIZE[0]
+            and header.height <= GEMINI_IMAGE_SIZE[1]):
+        return {"mime_type": mime_type, "data": buf}
+    # Re-encoding drops the EXIF block, so apply the camera's rotation here.
+    transpose = EXIF_TRANSPOSE.get(header.getexif().get(ExifTags.Base.Orientation))
+    return {"mime_type": "image/jpeg", "data": downscale_to_jpeg(buf, transpose)}
+
+
+def normalize_allergen_tag(tag):
+    # "en:tree_nuts" -> "tree nuts"
+    return tag.rpartition(":")[2].translate(ALLERGEN_TAG_TABLE).lower().strip()
+
+
+@functools.lru_cache(maxsize=1024)
+def allergy_pattern(allergies):
+    return re.compile("|".join(re.escape(a) for a in allergies))
+
+
+def contains_allergen(allergies, ingredients_text):
+    if sum(map(len, allergies)) <= MAX_CACHE_KEY_CHARS:
+        return allergy_pattern(allergies).search(ingredients_text) is not None
+    # Too large to keep a compiled pattern around (re caches patterns too), so
+    # fall back to plain substring checks per ingredient.
+    ingredients = ingredients_text.split("\n")
+    return any(a in ing for a in allergies for ing in ingredients)
+
+
+# Clients resend the same profile string with every scan; parse each one once.
+# Callers must treat the returned dict as read-only.
+@functools.lru_cache(maxsize=1024)
+def parse_cached_profile(profile_data):
+    return orjson.loads(profile_data)
+
+
+def parse_profile(profile_data):
+    if len(profile_data) <= MAX_CACHE_KEY_CHARS:
+        return parse_cached_profile(profile_data)
+    return orjson.loads(profile_data)
+
+
+def gemini_extract(image_bytes, speculative=False):
+    # Returns (extracted, raw_text), or None if a speculative call found no
+    # free Gemini slot and so never ran.
+    digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    key = f"{GEMINI_CACHE_VERSION}:{digest}"
+    while True:
+        with gemini_cache_lock:
+            cached = gemini_cache.get(key)
+            inflight = gemini_inflight.get(key) if cached is None else None
+            leader = cached is None and inflight is None
+            if leader:
+                inflight = gemini_inflight[key] = Future()
+        if cached is not None:
+            return cached, None
+        if leader:
+            break
+        result = inflight.result()
+        if result is not None:
+            return result
+        # The call we waited on was a skipped speculative one; try again.
+
+    redis_key = f"gem:{key}"
+    try:
+        shared = redis_get_json(redis_key)
+        if shared is not None:
+            result = (shared, None)
+        else:
+            result = run_gemini_extraction(image_bytes, speculative)
+            if result is not None and result[0] is not None:
+                redis_set_json(redis_key, result[0], GEMINI_REDIS_TTL)
+    except BaseException as e:
+        with gemini_cache_lock:
+            gemini_inflight.pop(key, None)
+        inflight.set_exception(e)
+        raise
+
+    with gemini_cache_lock:
+        if result is not None and result[0] is not None:
+            gemini_cache[key] = result[0]
+        gemini_inflight.pop(key, None)
+    inflight.set_result(result)
+    return result
+
+
+def run_gemini_extraction(image_bytes, speculative=False):
+    # A speculative call that finds no free slot returns before spending any
+    # work on the image; the request thread prepares it itself, ahead of
+    # waiting for a slot.
+    if speculative and not gemini_slots.acquire(blocking=False):
+        return None
+    try:
+        image_part = gemini_image_part(image_bytes)
+    except BaseException:
+        if speculative:
+            gemini_slots.release()
+        raise
+    if not speculative:
+        gemini_slots.acquire()
+    try:
+        response = GEMINI_MODEL.generate_content(
+            [PROMPT, image_part],
+            generation_config=GEMINI_JSON_CONFIG,
+            stream=True,
+        )
+        payload, response_text = read_json_object(chunk.text for chunk in response)
+    finally:
+        gemini_slots.release()
+    if payload is None:
+        return None, response_text
+    try:
+        extracted = orjson.loads(payload)
+    except orjson.JSONDecodeError:
+        return None, response_text
+    return extracted, response_text
+
+
+def read_json_object(chunks):
+    # Returns (first complete top-level JSON object, text read so far) and
+    # stops consuming the stream as soon as that object's closing brace
+    # arrives. Anything before the opening brace (e.g. a ```json fence) is
+    # skipped, and braces inside strings are ignored.
+    text = ""
+    start = None
+    depth = 0
+    in_string = False
+    escaped = False
+    for chunk in chunks:
+        offset = len(text)
+        text += chunk
+        for i in range(offset, len(text)):
+            char = text[i]
+            if start is None:
+                if char == "{":
+                    start = i
+                    depth = 1
+            elif in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1], text
+    return None, text
+
+
+def redis_get_json(key):
+    if redis_client is None:
+        return None
+    try:
+        cached = redis_client.get(key)
+    except redis.RedisError as e:
+        app.logger.warning("Redis GET %s failed: %s", key, e)
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+
+def redis_set_json(key, value, ttl):
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(key, ttl, orjson.dumps(value))
+    except redis.RedisError as e:
+        app.logger.warning("Redis SETEX %s failed: %s", key, e)
+
+
+def cached_openfoodfacts(barcode):
+    # Cache-only lookup across both tiers; never calls OpenFoodFacts.
+    with off_cache_lock:
+        cached = off_cache.get(barcode)
+    if cached is None:
+        cached = redis_get_json(f"off:{barcode}")
+        if cached is not None:
+            with off_cache_lock:
+                off_cache[barcode] = cached
+    return cached
+
+
+def fetch_and_cache_openfoodfacts(barcode):
+    result = fetch_openfoodfacts(barcode)
+    if result is not None:
+        redis_set_json(f"off:{barcode}", result, OFF_REDIS_TTL)
+        with off_cache_lock:
+            off_cache[barcode] = result
+    return result
+
+
+def fetch_openfoodfacts(barcode):
     url = f"https://world.openfoodfacts.org/api/v0/product/{barcode}.json"
-    response = requests.get(url)
+    try:
+        response = off_session.get(url, params={"fields": OFF_FIELDS}, timeout=OFF_TIMEOUT)
+    except requests.RequestException:
+        return None
     if response.status_code == 200:
-        data = response.json()
+        data = orjson.loads(response.content)
         if data.get("status") == 1:
             product = data["product"]
             return {
@@ -63,30 +433,55 @@ def query_openfoodfacts(barcode):
 
 
 def compute_pynutriscore(nutrition_facts):
+    product = {key: nutrition_facts.get(off_key, 0) for key, off_key in NUTRISCORE_INPUT_MAP}
     try:
-        score = NutriScore().calculate({
-            'energy': nutrition_facts.get("energy-kcal_100g", 0),
-            'fibers': nutrition_facts.get("fiber_100g", 0),
-            'fruit_percentage': nutrition_facts.get("fruits-vegetables-nuts_100g", 0),
-            'proteins': nutrition_facts.get("proteins_100g", 0),
-            'saturated_fats': nutrition_facts.get("saturated-fat_100g", 0),
-            'sodium': nutrition_facts.get("sodium_100g", 0),
-            'sugar': nutrition_facts.get("sugars_100g", 0),
-        }, 'solid')
-        grade = NutriScore().calculate_class({
-            'energy': nutrition_facts.get("energy-kcal_100g", 0),
-            'fibers': nutrition_facts.get("fiber_100g", 0),
-            'fruit_percentage': nutrition_facts.get("fruits-vegetables-nuts_100g", 0),
-            'proteins': nutrition_facts.get("proteins_100g", 0),
-            'saturated_fats': nutrition_facts.get("saturated-fat_100g", 0),
-            'sodium': nutrition_facts.get("sodium_100g", 0),
-            'sugar': nutrition_facts.get("sugars_100g", 0),
-        }, 'solid')
+        score = NUTRISCORE.calculate(product, 'solid')
+        grade = NUTRISCORE.calculate_class(product, 'solid')
         return score, grade
     except Exception:
         return None, None
 
 
+def custom_nutriscore(diet, allergies, ingredients):
+    key_chars = len(diet) + sum(map(len, allergies)) + sum(map(len, ingredients))
+    if key_chars <= MAX_CACHE_KEY_CHARS:
+        return cached_custom_nutriscore(diet, allergies, ingredients)
+    return score_ingredients(diet, allergies, ingredients)
+
+
+def score_ingredients(diet, allergies, ingredients):
+    score = 100
+    # One lowercase pass, then a single regex scan per keyword set; the
+    # newline separator keeps matches inside a single ingredient.
+    ingredients_text = "\n".join(i.lower() for i in ingredients)
+    if diet == "vegan":
+        if NON_VEGAN_RE.search(ingredients_text):
+            score -= 30
+    if ingredients and allergies and contains_allergen(allergies, ingredients_text):
+        score -= 30
+
+    grade = "A" if score >= 80 else "B" if score >= 60 else "C" if score >= 40 else "D" if score >= 20 else "E"
+    return score, grade
+
+
+# Pure function of the (hashable) profile and ingredient list, so repeat scans
+# of the same product by the same profile are a cache hit.
+cached_custom_nutriscore = functools.lru_cache(maxsize=4096)(score_ingredients)
+
+
+def warm_up():
+    # Pay the Gemini client bootstrap and the OpenFoodFacts TLS handshake
+    # before the first user request instead of during it.
+    try:
+        GEMINI_MODEL.count_tokens("warmup", request_options={"timeout": 5})
+    except Exception as e:
+        app.logger.warning("Gemini warm-up failed: %s", e)
+    try:
+        off_session.head("https://world.openfoodfacts.org", timeout=OFF_TIMEOUT)
+    except requests.RequestException as e:
+        app.logger.warning("OpenFoodFacts warm-up failed: %s", e)
+
+
 @app.route('/analyze', methods=['POST'])
 def analyze_image():
     image_file = request.files.get('image')
@@ -101,115 +496,108 @@ def analyze_image():
 
     if profile_data:
         try:
-            profile_json = json.loads(profile_data)
+            profile_json = parse_profile(profile_data)
             user_profile["allergies"] = profile_json.get("allergies", [])
             user_profile["diet"] = profile_json.get("diet", "none")
             user_profile["conditions"] = profile_json.get("conditions", [])
-        except json.JSONDecodeError:
-            return jsonify({"error": "Invalid JSON in profile"}), 400
-
-    image_path = None
-    if image_file:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-            image_path = tmp.name
-            image_file.save(image_path)
-
-    try:
-        extracted = None
-        nutriscore_score = None
-        nutriscore_grade = None
-
-        if barcode:
-            off_data = query_openfoodfacts(barcode)
-            if off_data:
-                user_allergies = [a.lower().strip() for a in user_profile.get("allergies", [])]
-                product_allergens = [a.split(":")[-1].replace("_", " ").lower().strip() for a in off_data.get("allergens", [])]
-
-                if any(allergen in product_allergens for allergen in user_allergies):
-                    return jsonify({
-                        "profile": user_profile,
-                        "source": "OpenFoodFacts",
-                        "analysis": {
-                            "ingredients": off_data["ingredients"],
-                            "nutrition_facts": off_data["nutrition_facts"],
-                            "allergens": product_allergens
-                        },
-                        "should_consume": "No",
-                        "nutriscore": {
-                            "score": 30,
-                            "grade": "D"
-                        },
-                        "reason": "Allergen conflict detected from OpenFoodFacts"
-                    })
-
-                extracted = {
-                    "ingredients": off_data["ingredients"],
-                    "nutrition_facts": {
-                        "Calories": off_data["nutrition_facts"].get("energy-kcal_100g", 0),
-                        "Total Fat": off_data["nutrition_facts"].get("fat_100g", 0),
-                        "Saturated Fat": off_data["nutrition_facts"].get("saturated-fat_100g", 0),
-                        "Sodium": off_data["nutrition_facts"].get("sodium_100g", 0),
-                        "Total Carbohydrate": off_data["nutrition_facts"].get("carbohydrates_100g", 0),
-                        "Sugar": off_data["nutrition_facts"].get("sugars_100g", 0),
-                        "Protein": off_data["nutrition_facts"].get("proteins_100g", 0)
-                    }
-                }
-
-                nutriscore_score = off_data["nutriscore_data"].get("score")
-                nutriscore_grade = off_data["nutriscore_data"].get("grade")
-
-                if nutriscore_score is None or nutriscore_grade in (None, "unknown"):
-                    nutriscore_score, nutriscore_grade = compute_pynutriscore(off_data["nutrition_facts"])
-
-        if not extracted:
-            if image_path:
-                image = Image.open(image_path)
-                response = genai.GenerativeModel("models/gemini-1.5-flash").generate_content([PROMPT, image])
-                clean_text = response.text.strip().strip("```json").strip("```").strip()
-                try:
-                    extracted = json.loads(clean_text)
-                except json.JSONDecodeError:
-                    return jsonify({
-                        "error": "Gemini output not JSON parseable",
-                        "raw_response": response.text
-                    }), 500
-            else:
-                return jsonify({
-                    "error": "No image or valid barcode provided. Please upload an image or enter a barcode."
-                }), 400
-
-        if nutriscore_score is None or nutriscore_grade is None:
-            nutriscore_score = 100
-            ingredients = [i.lower() for i in extracted.get("ingredients", [])]
-            if user_profile.get("diet", "").lower() == "vegan":
-                if any(word in ing for ing in ingredients for word in ["milk", "egg", "honey", "gelatin", "meat", "fish"]):
-                    nutriscore_score -= 30
-            user_allergies = [a.lower().strip() for a in user_profile.get("allergies", [])]
-            if any(a in ing for a in user_allergies for ing in ingredients):
-                nutriscore_score -= 30
-
-            nutriscore_grade = "A" if nutriscore_score >= 80 else "B" if nutriscore_score >= 60 else "C" if nutriscore_score >= 40 else "D" if nutriscore_score >= 20 else "E"
-
-        return jsonify({
-            "profile": user_profile,
-            "source": "OpenFoodFacts" if barcode else "Gemini",
-            "analysis": extracted,
-            "should_consume": "Yes" if nutriscore_score > 30 else "No",
-            "nutriscore": {
-                "score": nutriscore_score,
-                "grade": nutriscore_grade
+        except orjson.JSONDecodeError:
+            return json_response({"error": "Invalid JSON in profile"}), 400
+
+    user_allergies = {a.lower().strip() for a in user_profile.get("allergies", [])}
+    image_bytes = image_file.read() if image_file else None
+    extracted = None
+    nutriscore_score = None
+    nutriscore_grade = None
+
+    # With both a barcode and an image, start Gemini while OpenFoodFacts is
+    # queried so a lookup miss costs max(OFF, Gemini) rather than the sum.
+    # Once started, the speculative call runs to completion even if OFF hits
+    # (its result still lands in the extraction cache); that spend is the
+    # price of the overlap, so skip it for barcodes either cache tier knows.
+    off_data = cached_openfoodfacts(barcode) if barcode else None
+    gemini_future = None
+    if barcode and image_bytes and off_data is None:
+        gemini_future = gemini_executor.submit(gemini_extract, image_bytes, True)
+
+    if barcode:
+        if off_data is None:
+            off_data = fetch_and_cache_openfoodfacts(barcode)
+        if off_data:
+            # Only drops the call if it is still queued on the executor.
+            if gemini_future:
+                gemini_future.cancel()
+
+            product_allergens = [normalize_allergen_tag(a) for a in off_data.get("allergens", [])]
+
+            if not user_allergies.isdisjoint(product_allergens):
+                return json_response({
+                    "profile": user_profile,
+                    "source": "OpenFoodFacts",
+                    "analysis": {
+                        "ingredients": off_data["ingredients"],
+                        "nutrition_facts": off_data["nutrition_facts"],
+                        "allergens": product_allergens
+                    },
+                    "should_consume": "No",
+                    "nutriscore": {
+                        "score": 30,
+                        "grade": "D"
+                    },
+                    "reason": "Allergen conflict detected from OpenFoodFacts"
+                })
+
+            nutrition_facts = off_data["nutrition_facts"]
+            extracted = {
+                "ingredients": off_data["ingredients"],
+                "nutrition_facts": {key: nutrition_facts.get(off_key, 0) for key, off_key in OFF_NUTRIENT_MAP}
             }
-        })
-    finally:
-        if image_path:
-            os.remove(image_path)
+
+            nutriscore_score = off_data["nutriscore_data"].get("score")
+            nutriscore_grade = off_data["nutriscore_data"].get("grade")
+
+            if nutriscore_score is None or nutriscore_grade in (None, "unknown"):
+                nutriscore_score, nutriscore_grade = compute_pynutriscore(off_data["nutrition_facts"])
+
+    if not extracted:
+        if image_bytes:
+            result = gemini_future.result() if gemini_future else None
+            if result is None:
+                result = gemini_extract(image_bytes)
+            extracted, response_text = result
+            if extracted is None:
+                return json_response({
+                    "error": "Gemini output not JSON parseable",
+                    "raw_response": response_text
+                }), 500
+        else:
+            return json_response({
+                "error": "No image or valid barcode provided. Please upload an image or enter a barcode."
+            }), 400
+
+    if nutriscore_score is None or nutriscore_grade is None:
+        nutriscore_score, nutriscore_grade = custom_nutriscore(
+            user_profile.get("diet", "").lower(),
+            tuple(sorted(user_allergies)),
+            tuple(extracted.get("ingredients", [])),
+        )
+
+    return json_response({
+        "profile": user_profile,
+        "source": "OpenFoodFacts" if barcode else "Gemini",
+        "analysis": extracted,
+        "should_consume": "Yes" if nutriscore_score > 30 else "No",
+        "nutriscore": {
+            "score": nutriscore_score,
+            "grade": nutriscore_grade
+        }
+    })
 
 
 @app.route('/chat', methods=['POST'])
 def chat():
     data = request.get_json()
     if not data or 'message' not in data:
-        return jsonify({"error": "No message provided"}), 400
+        return json_response({"error": "No message provided"}), 400
 
     message = data['message']
     profile = data.get('profile', {
@@ -232,12 +620,12 @@ def chat():
     """
 
     try:
-        response = genai.GenerativeModel("models/gemini-1.5-flash").generate_content(chat_prompt)
-        return jsonify({
+        response = GEMINI_MODEL.generate_content(chat_prompt)
+        return json_response({
             "response": response.text.strip()
         })
     except Exception as e:
-        return jsonify({"error": "Gemini failed to respond", "details": str(e)}), 500
+        return json_response({"error": "Gemini failed to respond", "details": str(e)}), 500
 
 
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# /analyze spends almost all of its time waiting on Gemini and OpenFoodFacts,
+# so a few processes with many threads each keep plenty of calls in flight
+# without duplicating the model pipeline per thread.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+timeout = 60
+# Let the platform's load balancer reuse connections between requests.
+keepalive = 5
+
+# Import app.py (and load the model) once in the master; workers share it
+# copy-on-write after fork.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Network clients must not be shared across fork, so warm them per worker
+    # (before it accepts connections) rather than in the preloading master.
+    from app import warm_up
+    warm_up()